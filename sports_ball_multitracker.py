@@ -36,17 +36,32 @@ python tennis_ball_controller_multitrack.py --classes "sports ball,cup,banana" -
 python tennis_ball_controller_multitrack.py --list-classes
 """
 
+import os
+# Run the few ops MPS lacks on the CPU instead of erroring out (must be set before torch loads)
+os.environ.setdefault("PYTORCH_ENABLE_MPS_FALLBACK", "1")
+import sys
+import queue
+import socket
+import struct
 import cv2
 import time
 import argparse
+import threading
+import numpy as np
 from ultralytics import YOLO
-from pythonosc.udp_client import SimpleUDPClient
+from ultralytics.cfg import DEFAULT_CFG_DICT
+from ultralytics.data.utils import IMG_FORMATS
 
 try:
     import torch  # Optional (for device detection; works without)
 except Exception:
     torch = None
 
+try:
+    from numba import njit  # Optional (compiles the per-frame slot update)
+except Exception:
+    njit = None
+
 
 def parse_args():
     """Define and parse command-line arguments."""
@@ -65,7 +80,18 @@ def parse_args():
     ap.add_argument("--iou", type=float, default=0.45,
                     help="NMS IoU threshold.")
     ap.add_argument("--half", action="store_true",
-                    help="Half precision (CUDA only). Ignored on CPU/MPS.")
+                    help="Half precision (CUDA/MPS). Ignored on CPU.")
+    ap.add_argument("--engine", action="store_true",
+                    help="Export --model to a TensorRT engine (cached beside the .pt) and run that instead. "
+                         "CUDA only. Passing a .engine path to --model loads it directly.")
+    ap.add_argument("--cuda-graph", action="store_true",
+                    help="Capture the PyTorch forward pass as a CUDA graph and replay it each frame (CUDA .pt models).")
+    ap.add_argument("--int8", action="store_true",
+                    help="Like --engine but INT8-calibrated (falls back to FP16 on pre-Turing GPUs).")
+    ap.add_argument("--calib-dir", default="calib",
+                    help="Folder of representative frames for --int8 calibration; filled from --source if empty.")
+    ap.add_argument("--calib-frames", type=int, default=200,
+                    help="Number of frames to capture into --calib-dir when it is empty.")
 
     # Smoothing / stability
     ap.add_argument("--ema", type=float, default=0.25,
@@ -80,6 +106,10 @@ def parse_args():
                     help="Cap processing FPS (0 = uncapped).")
     ap.add_argument("--no-video", action="store_true",
                     help="Disable preview window (headless).")
+    ap.add_argument("--preview-every", type=int, default=1,
+                    help="Draw and show the preview only every Nth frame (tracking/OSC still run every frame).")
+    ap.add_argument("--profile", action="store_true",
+                    help="Print average per-stage timings (read/track/post/output) every 100 frames.")
     ap.add_argument("--overlay", action="store_true",
                     help="Force overlay drawing even with --no-video (useful for file output).")
 
@@ -92,6 +122,8 @@ def parse_args():
                     help="Base OSC path for per-slot data (e.g., /ball/1).")
     ap.add_argument("--count-path", default="/balls/count",
                     help="OSC path that reports number of active (non-sentinel) slots.")
+    ap.add_argument("--no-bundle", action="store_true",
+                    help="Send each OSC message as its own UDP packet instead of one bundle per frame.")
 
     # Slots / tracking
     ap.add_argument("--max-slots", type=int, default=3,
@@ -117,41 +149,528 @@ def choose_device(arg: str) -> str:
     return "cpu"
 
 
+def is_cuda(device: str) -> bool:
+    """True for CUDA device strings ('cuda', 'cuda:0', '0', '1', ...)."""
+    return device.startswith("cuda") or device.isdigit()
+
+
+def configure_backends(device: str) -> None:
+    """Let CUDA convs/matmuls use TF32 Tensor Cores and autotune cuDNN for the fixed --imgsz."""
+    if torch is None or not is_cuda(device):
+        return
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Input shape never changes, so the autotuner settles after the first frame
+    torch.backends.cudnn.benchmark = True
+
+
+def supports_int8(device: str) -> bool:
+    """INT8 Tensor Cores arrived with Turing (compute capability 7.5)."""
+    index = int(device) if device.isdigit() else (torch.device(device).index or 0)
+    return torch.cuda.get_device_capability(index) >= (7, 5)
+
+
+def prepare_calibration(args, names: dict) -> str:
+    """Fill --calib-dir with frames from --source (if empty) and return a dataset YAML for it."""
+    os.makedirs(args.calib_dir, exist_ok=True)
+    if not any(os.path.splitext(f)[1][1:].lower() in IMG_FORMATS for f in os.listdir(args.calib_dir)):
+        cap = open_capture(args.source)
+        if not cap.isOpened():
+            raise RuntimeError(f"Unable to open source: {args.source}")
+        print(f"Capturing {args.calib_frames} INT8 calibration frames into {args.calib_dir}/ ...")
+        for i in range(args.calib_frames):
+            ok, frame = cap.read()
+            if not ok:
+                break
+            cv2.imwrite(os.path.join(args.calib_dir, f"{i:04d}.jpg"), frame)
+        cap.release()
+
+    # Calibration only needs images; labels are not read. A YAML already in the folder is kept
+    calib_root = os.path.abspath(args.calib_dir)
+    yaml_path = os.path.join(calib_root, "calib.yaml")
+    if not os.path.exists(yaml_path):
+        with open(yaml_path, "w") as f:
+            f.write(f"path: {calib_root}\ntrain: .\nval: .\nnames:\n")
+            for i, n in names.items():
+                f.write(f'  {i}: "{n}"\n')
+    return yaml_path
+
+
+def use_half(args, device: str) -> bool:
+    """FP16 runs natively on CUDA and Apple-Silicon MPS GPUs; CPU stays FP32."""
+    return args.half and (is_cuda(device) or device == "mps")
+
+
+def precision_kwargs(bits: int) -> dict:
+    """Ultralytics argument selecting 8/16-bit precision; empty for FP32.
+
+    Newer Ultralytics replaces the deprecated half/int8 flags with quantize=16/8
+    (and warns on every call that still passes half).
+    """
+    if bits == 32:
+        return {}
+    if "quantize" in DEFAULT_CFG_DICT:
+        return {"quantize": bits}
+    return {"int8": True} if bits == 8 else {"half": True}
+
+
+def load_model(args, device: str) -> YOLO:
+    """Load the YOLO model on `device`, building/caching a TensorRT engine when --engine/--int8 is set.
+
+    The engine is built once for the fixed --imgsz (static shape → fastest TensorRT
+    tactics) and saved beside the .pt as e.g. yolov8n-320-fp16.engine; later runs
+    with the same settings load the cached file directly.
+    """
+    path = args.model
+    if (args.engine or args.int8) and not path.endswith(".engine"):
+        if not is_cuda(device):
+            raise RuntimeError("--engine/--int8 require a CUDA device (use --device cuda).")
+        int8 = args.int8 and supports_int8(device)
+        half = args.half or (args.int8 and not int8)  # FP16 fallback for pre-Turing GPUs
+        precision = "int8" if int8 else ("fp16" if half else "fp32")
+        engine_path = f"{os.path.splitext(path)[0]}-{args.imgsz}-{precision}.engine"
+        if not os.path.exists(engine_path):
+            pt_model = YOLO(path)
+            extra = precision_kwargs(8 if int8 else (16 if half else 32))
+            if int8:
+                extra["data"] = prepare_calibration(args, pt_model.names)
+            exported = pt_model.export(format="engine", imgsz=args.imgsz,
+                                       device=device, workspace=4, dynamic=False, **extra)
+            os.replace(exported, engine_path)
+        path = engine_path
+
+    model = YOLO(path)
+    if path.endswith(".engine"):
+        # Precision is baked into the engine, but without a device the predictor
+        # runs it on the current CUDA device rather than the one it was built for
+        model.overrides["device"] = device
+        return model
+    model.to(device)
+    if use_half(args, device):
+        try:
+            model.model.half()
+        except Exception:
+            pass
+    return model
+
+
+def _try_capture(source, backend: int, params: list):
+    """Open `source` with a specific backend/params; None if unsupported or not opened."""
+    try:
+        cap = cv2.VideoCapture(source, backend, params) if params else cv2.VideoCapture(source, backend)
+    except cv2.error:
+        return None
+    if not cap.isOpened():
+        cap.release()
+        return None
+    return cap
+
+
 def open_capture(source: str) -> cv2.VideoCapture:
-    """Open a camera index or video file/URL with sane defaults for webcam."""
+    """Open a camera index or video file/URL with sane defaults for webcam.
+
+    Prefers the platform's native camera backend and FFmpeg for files/URLs, asking for
+    hardware-accelerated decode where OpenCV supports it; falls back silently to the
+    default backend otherwise.
+    """
+    hw = ([cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+          if hasattr(cv2, "CAP_PROP_HW_ACCELERATION") else [])
     try:
         idx = int(source)
-        cap = cv2.VideoCapture(idx)
-        # Modest capture size helps CPU performance
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
     except ValueError:
-        cap = cv2.VideoCapture(source)
+        return _try_capture(source, cv2.CAP_FFMPEG, hw) or cv2.VideoCapture(source)
+
+    backend = {"linux": cv2.CAP_V4L2, "win32": cv2.CAP_MSMF,
+               "darwin": cv2.CAP_AVFOUNDATION}.get(sys.platform, cv2.CAP_ANY)
+    cap = _try_capture(idx, backend, hw) or _try_capture(idx, backend, []) or cv2.VideoCapture(idx)
+    # MJPEG avoids the USB bandwidth cap of raw YUV, allowing full frame rate
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    # Modest capture size helps CPU performance
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    # Keep the driver queue shallow; FrameReader already holds the latest frame
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
     return cap
 
 
+class FrameReader:
+    """Background capture thread so cap.read() overlaps with inference.
+
+    Holds a single latest-frame slot. For live sources (cameras, streams) stale
+    frames are overwritten so the tracker always sees the newest image; for video
+    files the reader waits until each frame is taken so none are skipped. The reader
+    owns the capture and releases it on exit, never under a read still in progress.
+    """
+    def __init__(self, cap: cv2.VideoCapture, drop_stale: bool):
+        self.cap = cap
+        self.drop_stale = drop_stale
+        self.cond = threading.Condition()
+        self.latest = None
+        self.done = False                   # end of stream or stop() requested
+        self.thread = threading.Thread(target=self._reader, daemon=True)
+        self.thread.start()
+
+    def _reader(self):
+        try:
+            while not self.done:
+                ok, frame = self.cap.read()
+                with self.cond:
+                    if not ok:
+                        self.done = True
+                        self.cond.notify_all()
+                        return
+                    while not self.drop_stale and self.latest is not None and not self.done:
+                        self.cond.wait()
+                    self.latest = frame
+                    self.cond.notify_all()
+        finally:
+            self.cap.release()
+
+    def read(self):
+        """Block until a new frame is available; returns None at end of stream."""
+        with self.cond:
+            while self.latest is None and not self.done:
+                self.cond.wait()
+            frame, self.latest = self.latest, None
+            self.cond.notify_all()
+        return frame
+
+    def stop(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+        self.thread.join(timeout=1.0)
+
+
+def _osc_string(text: str) -> bytes:
+    """Encode an OSC string: NUL-terminated and padded to a multiple of 4 bytes."""
+    raw = text.encode() + b"\0"
+    return raw + b"\0" * (-len(raw) % 4)
+
+
+class OscSender:
+    """Pre-encoded OSC output over a raw non-blocking UDP socket.
+
+    Addresses and type tags never change, so the packet layout is built once at
+    startup and each frame only packs the argument values into it. By default the
+    per-slot messages and the count go out as one bundle (one sendto() per frame);
+    with bundle=False each message is its own datagram, for receivers that expect that.
+    """
+    def __init__(self, host: str, port: int, slot_paths: list, count_path: str, bundle: bool = True):
+        family, _, _, _, self.addr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        messages = [_osc_string(p) + _osc_string(",fff") for p in slot_paths]
+        messages.append(_osc_string(count_path) + _osc_string(",i"))
+        arg_sizes = [12] * len(slot_paths) + [4]
+        fields = []                         # (buffer, offset) of each message's arguments
+        if bundle:
+            buf = bytearray(b"#bundle\0" + struct.pack(">Q", 1))   # time tag 1 = immediately
+            for head, size in zip(messages, arg_sizes):
+                buf += struct.pack(">i", len(head) + size) + head
+                fields.append((buf, len(buf)))
+                buf += bytes(size)
+            self.packets = [buf]
+        else:
+            self.packets = [bytearray(head + bytes(size)) for head, size in zip(messages, arg_sizes)]
+            fields = [(pkt, len(head)) for pkt, head in zip(self.packets, messages)]
+        self.slot_fields, self.count_field = fields[:-1], fields[-1]
+
+    def send(self, rows: list, n_active: int):
+        """Send per-slot [x, y, size] rows and the active-slot count."""
+        for (buf, offset), row in zip(self.slot_fields, rows):
+            struct.pack_into(">fff", buf, offset, *row)
+        buf, offset = self.count_field
+        struct.pack_into(">i", buf, offset, n_active)
+        for pkt in self.packets:
+            try:
+                self.sock.sendto(pkt, self.addr)
+            except OSError:
+                pass                        # socket buffer full/network hiccup: drop, don't stall tracking
+
+
+class OscWorker:
+    """Runs OscSender on a background thread so a slow or lossy network never delays
+    capture and inference.
+
+    The queue holds at most two frames; when it is full the oldest one is dropped
+    (its values are stale anyway) instead of blocking the tracking loop.
+    """
+    def __init__(self, sender: OscSender):
+        self.sender = sender
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.sender.send(*item)
+
+    def send(self, rows: list, n_active: int):
+        item = (rows, n_active)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(item)     # single producer, so there is room now
+
+    def stop(self):
+        """Flush queued frames and stop the thread."""
+        self.queue.put(None)
+        self.thread.join(timeout=1.0)
+
+
+class Preprocessor:
+    """Drop-in for the Ultralytics predictor's preprocess() that reuses one input buffer.
+
+    Frames are letterboxed into a single uint8 host buffer. On GPUs it is uploaded
+    (page-locked on CUDA, so as a non-blocking DMA queued ahead of the forward pass)
+    and reordered/normalized on the model's device; on CPU one cv2.dnn.blobFromImage()
+    call (OpenCV's SIMD C++ path) does BGR→RGB, HWC→CHW and /255 together. The letterbox
+    size comes from the predictor's own pre_transform(), so postprocess() maps boxes
+    back to the frame exactly as before.
+    """
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.fallback = predictor.preprocess
+        self.device = predictor.device
+        self.cuda = self.device.type == "cuda"
+        self.shape = None                   # frame shape the buffer was sized for
+
+    def _allocate(self, frame):
+        h0, w0 = frame.shape[:2]
+        h1, w1 = self.predictor.pre_transform([frame])[0].shape[:2]
+        r = min(self.predictor.imgsz[0] / h0, self.predictor.imgsz[1] / w0)
+        nw, nh = int(round(w0 * r)), int(round(h0 * r))
+        left, top = int(round((w1 - nw) / 2 - 0.1)), int(round((h1 - nh) / 2 - 0.1))
+        self.host = torch.full((1, h1, w1, 3), 114, dtype=torch.uint8, pin_memory=self.cuda)
+        self.canvas = self.host.numpy()[0]
+        self.roi = self.canvas[top:top + nh, left:left + nw]
+        self.size = (nw, nh)
+        self.shape = frame.shape
+
+    def __call__(self, im):
+        # Tensor inputs and batches keep the stock path
+        if isinstance(im, torch.Tensor) or len(im) != 1:
+            return self.fallback(im)
+        frame = im[0]
+        if frame.shape != self.shape:
+            self._allocate(frame)
+        if frame.shape[1::-1] == self.size:
+            self.roi[...] = frame
+        else:
+            self.roi[...] = cv2.resize(frame, self.size, interpolation=cv2.INTER_LINEAR)
+
+        if self.device.type == "cpu":
+            x = torch.from_numpy(cv2.dnn.blobFromImage(self.canvas, 1 / 255.0, swapRB=True))
+            return x.half() if self.predictor.model.fp16 else x
+
+        # Safe to reuse the buffer next frame: the tracker copies boxes back to the host,
+        # which waits for this upload (queued earlier on the same stream) to finish
+        x = self.host.to(self.device, non_blocking=self.cuda)
+        x = x.permute(0, 3, 1, 2).flip(1).contiguous()  # BHWC → BCHW, BGR → RGB
+        return (x.half() if self.predictor.model.fp16 else x.float()).div_(255)
+
+
+class CudaGraphRunner:
+    """Drop-in for the predictor's inference() that replays a captured CUDA graph.
+
+    With a fixed camera resolution and --imgsz the forward pass is static, so after a
+    few warmup frames (letting cuDNN's autotuner settle) it is captured once; each later
+    frame is a copy into the static input plus graph.replay(), which removes the
+    per-kernel launch overhead that dominates small models. Falls back to the stock
+    path if the input shape changes or capture fails.
+    """
+    def __init__(self, predictor, warmup: int = 5):
+        self.fallback = predictor.inference
+        self.warmup = warmup
+        self.graph = None
+        self.failed = False
+
+    def _capture(self, im, *args, **kwargs):
+        self.static_in = im.clone()
+        # Warm up on a side stream so lazily allocated buffers exist before capture
+        side = torch.cuda.Stream(im.device)
+        side.wait_stream(torch.cuda.current_stream(im.device))
+        with torch.cuda.stream(side):
+            for _ in range(3):
+                self.fallback(self.static_in, *args, **kwargs)
+        torch.cuda.current_stream(im.device).wait_stream(side)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self.static_out = self.fallback(self.static_in, *args, **kwargs)
+        self.graph = graph
+
+    def __call__(self, im, *args, **kwargs):
+        if self.graph is None:
+            if self.failed or self.warmup > 0:
+                self.warmup -= 1
+                return self.fallback(im, *args, **kwargs)
+            try:
+                self._capture(im, *args, **kwargs)
+            except Exception as e:
+                print(f"CUDA graph capture failed ({e}); using regular inference.")
+                self.failed = True
+                return self.fallback(im, *args, **kwargs)
+        if im.shape != self.static_in.shape or im.dtype != self.static_in.dtype:
+            return self.fallback(im, *args, **kwargs)
+        self.static_in.copy_(im)
+        self.graph.replay()
+        return self.static_out
+
+
+class StageProfiler:
+    """Accumulates per-stage wall time and prints averages every `every` frames.
+
+    On CUDA each mark synchronizes first, so GPU work is charged to the stage that
+    queued it rather than to whichever stage happens to block on it.
+    """
+    def __init__(self, sync_cuda: bool, every: int = 100):
+        self.sync_cuda = sync_cuda
+        self.every = every
+        self.totals = {}
+        self.frames = 0
+        self.t = time.perf_counter()
+
+    def mark(self, stage: str):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + (t - self.t)
+        self.t = t
+
+    def end_frame(self):
+        self.frames += 1
+        if self.frames >= self.every:
+            print("  ".join(f"{k} {v * 1000 / self.frames:.2f} ms" for k, v in self.totals.items()))
+            self.totals, self.frames = {}, 0
+
+
+SENTINEL = (-1.0, -1.0, 0.0)                # sent for slots with no target
+
+
+def _update_slots(tids, cx, cy, area, frame_w, frame_h, min_area, ema, hold,
+                  slot_to_track, ema_state, last_out, has_value, misses, slot_det, fresh):
+    """Per-frame slot assignment, EMA and hold for all slots (compiled with Numba when available).
+
+    Detections arrive largest first. Slot policy:
+    1) Keep existing track->slot assignments where possible
+    2) Fill free slots with new tracks
+    3) If no free slots, replace the smallest-area slot if the new detection is larger
+    Fresh slots are EMA-smoothed, missing slots hold their last value for up to `hold`
+    frames and then fall back to the sentinel. All state arrays are updated in place;
+    returns the number of active (non-sentinel) slots.
+    """
+    n_slots = slot_to_track.shape[0]
+    n_det = tids.shape[0]
+    slot_area = np.zeros(n_slots)
+    det_slot = np.full(n_det, -1)
+    for j in range(n_det):
+        for s in range(n_slots):
+            if slot_to_track[s] == tids[j]:
+                det_slot[j] = s
+                slot_area[s] = area[j]
+                break
+
+    for j in range(n_det):
+        if det_slot[j] >= 0:
+            continue
+        free = -1
+        for s in range(n_slots):
+            if slot_to_track[s] < 0:
+                free = s
+                break
+        if free < 0:
+            free = np.argmin(slot_area)
+            if area[j] <= slot_area[free]:
+                continue
+        slot_to_track[free] = tids[j]
+        slot_area[free] = area[j]
+        det_slot[j] = free
+
+    # A detection keeps its slot only if it was not evicted above
+    slot_det[:] = -1
+    for j in range(n_det):
+        s = det_slot[j]
+        if s >= 0 and slot_to_track[s] == tids[j]:
+            slot_det[s] = j
+
+    n_active = 0
+    for s in range(n_slots):
+        j = slot_det[s]
+        fresh[s] = False
+        if j >= 0:
+            x = cx[j] / frame_w
+            y = cy[j] / frame_h
+            size = area[j] / (frame_w * frame_h)
+            if size >= min_area:
+                fresh[s] = True
+                misses[s] = 0
+                if ema > 0:
+                    if np.isnan(ema_state[s, 0]):
+                        ema_state[s, 0], ema_state[s, 1], ema_state[s, 2] = x, y, size
+                    else:
+                        ema_state[s, 0] = (1 - ema) * ema_state[s, 0] + ema * x
+                        ema_state[s, 1] = (1 - ema) * ema_state[s, 1] + ema * y
+                        ema_state[s, 2] = (1 - ema) * ema_state[s, 2] + ema * size
+                    last_out[s, :] = ema_state[s, :]
+                else:
+                    last_out[s, 0], last_out[s, 1], last_out[s, 2] = x, y, size
+                has_value[s] = True
+                n_active += 1
+                continue
+
+        # No fresh detection: hold last known value, then send sentinel and reset smoothing
+        if has_value[s] and misses[s] < hold:
+            misses[s] += 1
+            if last_out[s, 2] > 0:
+                n_active += 1
+        else:
+            last_out[s, 0], last_out[s, 1], last_out[s, 2] = -1.0, -1.0, 0.0
+            ema_state[s, :] = np.nan
+            has_value[s] = False
+    return n_active
+
+
+update_slots = njit(cache=True)(_update_slots) if njit is not None else _update_slots
+
+
 class SlotState:
-    """Per-slot smoothing/hold state."""
-    def __init__(self):
-        self.ema = [None, None, None]       # [x, y, size]
-        self.last_out = [-1.0, -1.0, 0.0]   # sentinel until first valid value
-        self.misses = 0
-        self.has_value = False              # whether we have emitted a valid value
+    """Track↔slot mapping plus smoothing/hold state, one row per slot."""
+    def __init__(self, n_slots: int):
+        self.slot_to_track = np.full(n_slots, -1)           # slot index -> tracker ID (-1 = free)
+        self.ema = np.full((n_slots, 3), np.nan)             # [x, y, size]; NaN until first valid value
+        self.last_out = np.tile(SENTINEL, (n_slots, 1))      # sentinel until first valid value
+        self.misses = np.zeros(n_slots, dtype=np.int64)
+        self.has_value = np.zeros(n_slots, dtype=np.bool_)   # whether we have emitted a valid value
+        self.slot_det = np.full(n_slots, -1)                 # this frame's detection row per slot (-1 = none)
+        self.fresh = np.zeros(n_slots, dtype=np.bool_)       # slots updated from a detection this frame
+
+    def update(self, tids, cx, cy, area, frame_w: int, frame_h: int,
+               min_area: float, ema: float, hold: int) -> int:
+        """Assign this frame's detections to slots and update every slot; returns n_active."""
+        return update_slots(tids, cx, cy, area, float(frame_w), float(frame_h), float(min_area),
+                            float(ema), int(hold), self.slot_to_track, self.ema, self.last_out,
+                            self.has_value, self.misses, self.slot_det, self.fresh)
 
 
 def main():
     args = parse_args()
 
     # Load model and set device/precision
-    model = YOLO(args.model)
     device = choose_device(args.device)
-    model.to(device)
-    if args.half and device == "cuda":
-        # FP16 is CUDA-only in this context
-        try:
-            model.model.half()
-        except Exception:
-            pass
+    configure_backends(device)
+    # Ultralytics re-casts the model to FP32 unless told; passed only when --half is on
+    precision = precision_kwargs(16 if use_half(args, device) else 32)
+    model = load_model(args, device)
 
     # Class name dictionary from model
     names = getattr(model, "names", None) or getattr(model.model, "names", None)
@@ -169,48 +688,76 @@ def main():
 
     # Map requested class names → IDs
     wanted = [c.strip().lower() for c in args.classes.split(",") if c.strip()]
-    target_ids = [name2id[c] for c in wanted if c in name2id]
+    target_set = frozenset(name2id[c] for c in wanted if c in name2id)
+    target_ids = sorted(target_set)           # list form for model.track(classes=...)
     if not target_ids:
         sample = ", ".join(list(name2id.keys())[:10])
         raise RuntimeError(f"No matching classes for --classes '{args.classes}'. "
                            f"Examples: {sample} ...")
 
-    # OSC client
-    client = SimpleUDPClient(args.osc_host, args.osc_port)
+    # OSC output (packet layout precomputed for the slot paths)
+    slot_paths = [f"{args.base_path}/{s}" for s in range(1, args.max_slots + 1)]
+    osc = OscWorker(OscSender(args.osc_host, args.osc_port, slot_paths, args.count_path,
+                              bundle=not args.no_bundle))
 
     # Video source
     cap = open_capture(args.source)
     if not cap.isOpened():
         raise RuntimeError(f"Unable to open source: {args.source}")
+    reader = FrameReader(cap, drop_stale=not os.path.isfile(args.source))
 
     # Track-ID ↔ slot mapping and state
-    track_to_slot = {}                        # tracker ID -> slot index
-    slot_to_track = {}                        # slot index -> tracker ID
-    slots = {i: SlotState() for i in range(1, args.max_slots + 1)}
+    slots = SlotState(args.max_slots)
+    id2name_arr = [id2name.get(i, "?") for i in range(max(id2name) + 1)]
+    is_target = np.zeros(len(id2name_arr), dtype=bool)     # class guard as an O(1) lookup per box
+    is_target[list(target_set)] = True
+    no_boxes = np.empty((0, 4), dtype=np.float32)
+    no_ids = np.empty(0, dtype=int)
+    # Compile the slot update now (no detections → state stays at sentinels) rather than on frame 1
+    no_vals = np.empty(0, dtype=np.float32)
+    slots.update(no_ids, no_vals, no_vals, no_vals, 1, 1, args.min_area, args.ema, args.hold)
 
     # FPS throttling / display
     frame_interval = (1.0 / args.fps_cap) if args.fps_cap > 0 else 0.0
-    last_tick = 0.0
-    fps_show, fps_t0, fps_count = 0.0, time.time(), 0
+    last_tick = float("-inf")
+    fps_t0, fps_count = time.perf_counter(), 0
+    fps_text = f"FPS 0.0   conf>={args.conf}  imgsz={args.imgsz}  active="   # rebuilt on FPS updates
+    preview_every = max(1, args.preview_every)
+    frame_idx = 0
 
     # UI window
     title = "YOLO Multi-Track (OSC)"
     if not args.no_video:
         cv2.namedWindow(title, cv2.WINDOW_NORMAL)
 
+    preprocessor = None                       # installed once the predictor exists
+    prof = StageProfiler(torch is not None and is_cuda(device)) if args.profile else None
+
+    # Hot-loop callables bound to locals (skips attribute lookups per call)
+    _send = osc.send
+    _rect, _circle, _put = cv2.rectangle, cv2.circle, cv2.putText
+
     try:
         while True:
-            # Optional FPS cap to reduce CPU load and stabilize timing
+            frame = reader.read()
+            if frame is None:
+                break
+            t = time.perf_counter()                # single clock read per frame
+
+            # Optional FPS cap to reduce CPU load and stabilize timing. Live sources keep
+            # decoding at the camera rate and frames that arrive before the next inference
+            # slot are dropped, so inference always runs on a fresh frame; video files are
+            # paced with a sleep instead so no frame is skipped.
             if frame_interval > 0:
-                now = time.time()
-                wait = frame_interval - (now - last_tick)
+                wait = frame_interval - (t - last_tick)
                 if wait > 0:
+                    if reader.drop_stale:
+                        continue
                     time.sleep(wait)
-                last_tick = time.time()
-
-            ok, frame = cap.read()
-            if not ok:
-                break
+                    t += wait
+                last_tick = t
+            if prof is not None:
+                prof.mark("read")
             h, w = frame.shape[:2]
 
             # ---- Tracking inference (persistent IDs) ----
@@ -224,176 +771,96 @@ def main():
                 persist=True,              # keep tracker state across frames
                 verbose=False,
                 max_det=max(3, args.max_slots),
-                agnostic_nms=False
+                agnostic_nms=False,
+                **precision
             )
-
-            # Collect current detections with tracker IDs
-            dets = []  # each: {track_id, cx, cy, area, box, cls}
+            if preprocessor is None and torch is not None and model.predictor is not None:
+                preprocessor = model.predictor.preprocess = Preprocessor(model.predictor)
+                # TensorRT engines manage their own execution; graphs are for the PyTorch path
+                if args.cuda_graph and preprocessor.cuda and not str(model.ckpt_path or "").endswith(".engine"):
+                    model.predictor.inference = CudaGraphRunner(model.predictor)
+            if prof is not None:
+                prof.mark("track")
+
+            # Collect current detections as column arrays from a single device→host copy
+            # of the tracked box table (rows: x1, y1, x2, y2, track_id, conf, cls)
+            xyxy, clses, tids = no_boxes, no_ids, no_ids
             if results and len(results) > 0:
-                r = results[0]
-                if r.boxes is not None and len(r.boxes) > 0:
-                    ids = None
-                    if hasattr(r.boxes, "id") and r.boxes.id is not None:
-                        ids = r.boxes.id.cpu().numpy().astype(int)
-                    for i, b in enumerate(r.boxes):
-                        # Confidence guard (trackers can pass a few low-conf)
-                        conf = float(b.conf.item()) if hasattr(b.conf, "item") else float(b.conf)
-                        if conf < args.conf:
-                            continue
-                        # Class guard (should already be filtered)
-                        cls_id = int(b.cls.item()) if hasattr(b.cls, "item") else int(b.cls)
-                        if cls_id not in target_ids:
-                            continue
-
-                        x1, y1, x2, y2 = b.xyxy[0].cpu().numpy()
-                        bw = max(0.0, x2 - x1)
-                        bh = max(0.0, y2 - y1)
-                        area = bw * bh
-                        cx = (x1 + x2) * 0.5
-                        cy = (y1 + y2) * 0.5
-
-                        # Track ID (can be -1 when unassigned)
-                        track_id = None
-                        if ids is not None and i < len(ids):
-                            tid = int(ids[i])
-                            if tid >= 0:
-                                track_id = tid
-
-                        if track_id is not None:
-                            dets.append({
-                                "track_id": track_id,
-                                "cx": cx, "cy": cy,
-                                "area": area,
-                                "box": (int(x1), int(y1), int(x2), int(y2)),
-                                "cls": cls_id
-                            })
+                boxes = results[0].boxes
+                # Boxes without tracker IDs (no confirmed tracks this frame) are skipped
+                if boxes is not None and len(boxes) > 0 and boxes.is_track:
+                    data = boxes.data.cpu().numpy()
+                    xyxy = data[:, :4]
+                    ids = data[:, 4].astype(int)
+                    confs = data[:, 5]
+                    clses = data[:, 6].astype(int)
+                    # Confidence guard (trackers can pass a few low-conf), class guard
+                    # (should already be filtered) and assigned track IDs only (-1 = unassigned)
+                    keep = (confs >= args.conf) & is_target[clses] & (ids >= 0)
+                    xyxy, clses, tids = xyxy[keep], clses[keep], ids[keep]
+            cx = (xyxy[:, 0] + xyxy[:, 2]) * 0.5
+            cy = (xyxy[:, 1] + xyxy[:, 3]) * 0.5
+            area = np.maximum(xyxy[:, 2] - xyxy[:, 0], 0.0) * np.maximum(xyxy[:, 3] - xyxy[:, 1], 0.0)
 
             # Keep at most --max-slots detections (largest areas = closest/most visible)
-            if len(dets) > args.max_slots:
-                dets.sort(key=lambda d: d["area"], reverse=True)
-                dets = dets[:args.max_slots]
-
-            # Slot selection logic:
-            # 1) Keep existing track->slot assignments where possible
-            # 2) Fill free slots with new tracks
-            # 3) If no free slots, replace the smallest-area slot if the new detection is larger
-            slot_area = {s: 0.0 for s in range(1, args.max_slots + 1)}
-            for d in dets:
-                if d["track_id"] in track_to_slot:
-                    s = track_to_slot[d["track_id"]]
-                    slot_area[s] = d["area"]
-
-            for d in dets:
-                tid = d["track_id"]
-                if tid in track_to_slot:
-                    continue
-                free_slot = next((s for s in range(1, args.max_slots + 1) if s not in slot_to_track), None)
-                if free_slot is not None:
-                    track_to_slot[tid] = free_slot
-                    slot_to_track[free_slot] = tid
-                    slot_area[free_slot] = d["area"]
-                else:
-                    smallest_slot = min(slot_area, key=lambda s: slot_area[s])
-                    if d["area"] > slot_area[smallest_slot]:
-                        old_tid = slot_to_track.get(smallest_slot)
-                        if old_tid is not None:
-                            track_to_slot.pop(old_tid, None)
-                        track_to_slot[tid] = smallest_slot
-                        slot_to_track[smallest_slot] = tid
-                        slot_area[smallest_slot] = d["area"]
-
-            # Build slot->detection map for this frame
-            slot_det = {s: None for s in range(1, args.max_slots + 1)}
-            for d in dets:
-                s = track_to_slot.get(d["track_id"], None)
-                if s is not None and 1 <= s <= args.max_slots:
-                    slot_det[s] = d
-
-            # Emit per-slot data (with EMA, hold, and sentinels)
-            n_active = 0
-            drew_overlay = False
-            for s in range(1, args.max_slots + 1):
-                st = slots[s]
-                d = slot_det[s]
-                path = f"{args.base_path}/{s}"
-
-                if d is not None:
-                    x_norm = float(d["cx"]) / float(w)
-                    y_norm = float(d["cy"]) / float(h)
-                    size_norm = float(d["area"]) / float(w * h)
-
-                    if size_norm >= args.min_area:
-                        st.misses = 0
-                        if args.ema > 0:
-                            a = args.ema
-                            if st.ema[0] is None:
-                                st.ema = [x_norm, y_norm, size_norm]
-                            else:
-                                st.ema[0] = (1 - a) * st.ema[0] + a * x_norm
-                                st.ema[1] = (1 - a) * st.ema[1] + a * y_norm
-                                st.ema[2] = (1 - a) * st.ema[2] + a * size_norm
-                            out = [st.ema[0], st.ema[1], st.ema[2]]
-                        else:
-                            out = [x_norm, y_norm, size_norm]
-
-                        st.last_out = out
-                        st.has_value = True
-                        client.send_message(path, out)
-                        n_active += 1
-
-                        # Optional overlay
-                        if (not args.no_video) or args.overlay:
-                            x1, y1, x2, y2 = d["box"]
-                            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                            cv2.circle(frame, (int(d["cx"]), int(d["cy"])), 6, (0, 255, 0), -1)
-                            label = f"{s}:{id2name.get(d['cls'],'?')}"
-                            cv2.putText(frame, label, (x1, max(0, y1 - 8)),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-                            drew_overlay = True
-                    else:
-                        d = None  # fall through to "miss" branch below
-
-                if d is None:
-                    # No fresh detection for this slot this frame
-                    if st.has_value and st.misses < args.hold:
-                        st.misses += 1
-                        client.send_message(path, st.last_out)  # hold last known value
-                        if st.last_out[2] > 0:
-                            n_active += 1
-                    else:
-                        # Send sentinel and reset smoothing
-                        st.last_out = [-1.0, -1.0, 0.0]
-                        st.ema = [None, None, None]
-                        st.has_value = False
-                        client.send_message(path, st.last_out)
-
-            # Report number of active (non-sentinel) slots
-            client.send_message(args.count_path, n_active)
+            # argpartition is O(N); only the k survivors are ordered (largest first)
+            # so new tracks still claim free slots in the same order as before
+            k = args.max_slots
+            if area.size > k:
+                idx = np.argpartition(-area, k)[:k]
+                idx = idx[np.argsort(-area[idx])]
+                xyxy, clses, tids = xyxy[idx], clses[idx], tids[idx]
+                cx, cy, area = cx[idx], cy[idx], area[idx]
+
+            # Assign detections to slots and update every slot (EMA, hold, and sentinels),
+            # then queue per-slot data and the number of active slots for the OSC worker
+            n_active = slots.update(tids, cx, cy, area, w, h, args.min_area, args.ema, args.hold)
+            fresh, slot_det = slots.fresh, slots.slot_det
+            if prof is not None:
+                prof.mark("post")
+            _send(slots.last_out.tolist(), n_active)
+
+            # Optional overlay (preview frames only, unless forced with --overlay)
+            frame_idx += 1
+            show = not args.no_video and frame_idx % preview_every == 0
+            drew_overlay = bool(fresh.any())
+            if show or args.overlay:
+                for i in np.flatnonzero(fresh).tolist():
+                    j = slot_det[i]
+                    x1, y1, x2, y2 = xyxy[j].astype(int).tolist()
+                    _rect(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                    _circle(frame, (int(cx[j]), int(cy[j])), 6, (0, 255, 0), -1)
+                    label = f"{i + 1}:{id2name_arr[clses[j]]}"
+                    _put(frame, label, (x1, max(0, y1 - 8)), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
 
             # FPS overlay
             fps_count += 1
             if fps_count >= 10:
-                t1 = time.time()
-                fps_show = fps_count / (t1 - fps_t0)
-                fps_t0 = t1
+                fps_text = f"FPS {fps_count / (t - fps_t0):.1f}   conf>={args.conf}  imgsz={args.imgsz}  active="
+                fps_t0 = t
                 fps_count = 0
 
             # Preview window
-            if not args.no_video:
-                txt = f"FPS {fps_show:.1f}   conf>={args.conf}  imgsz={args.imgsz}  active={n_active}"
+            if show:
                 color = (0, 255, 0) if drew_overlay else (0, 0, 255)
-                cv2.putText(frame, txt, (10, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+                _put(frame, fps_text + str(n_active), (10, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
                 if not drew_overlay:
-                    cv2.putText(frame, "No targets (holding prior slots where possible)",
-                                (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 255), 2)
+                    _put(frame, "No targets (holding prior slots where possible)",
+                         (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 255), 2)
                 cv2.imshow(title, frame)
+            if not args.no_video:
+                # Pump window events every frame so the window stays responsive
                 key = cv2.waitKey(1) & 0xFF
                 if key in (27, ord('q')):  # Esc or q
                     break
+            if prof is not None:
+                prof.mark("output")
+                prof.end_frame()
 
     finally:
         # Clean up resources
-        cap.release()
+        reader.stop()                         # also releases cap once its read returns
+        osc.stop()
         if not args.no_video:
             cv2.destroyAllWindows()
 